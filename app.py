@@ -2,10 +2,18 @@ import streamlit as st
 from PIL import Image
 import pandas as pd
 import re
-from fuzzywuzzy import fuzz
+import html
+import math
+import os
+import hashlib
+import pickle
+import tempfile
+import threading
+from rapidfuzz import fuzz, process, utils
 from io import BytesIO
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import time
-import difflib
 import numpy as np
 
 # Streamlit page config
@@ -175,52 +183,359 @@ def show_loading(message):
 def hide_loading():
     loading_placeholder.empty()
 
-# Upload file
-uploaded_file = st.file_uploader("Upload HMV Excel File (hmv_data.xlsx format):", type=["xlsx"])
+_DATE_RE = re.compile(r'\b\d{1,2}[-/]\d{1,2}[-/]\d{2,4}\b')
+_WS_RE = re.compile(r'\s+')
+# Descriptions also drop the "(FOR REFERENCE ONLY)" tag, in the same pass as dates
+_DESC_STRIP_RE = re.compile(r'\(FOR REFERENCE ONLY\)|' + _DATE_RE.pattern)
 
-if uploaded_file:
-    show_loading("🔍 Processing your file...")
-    
-    df = pd.read_excel(uploaded_file)
+# Used for the typed query; workbook columns go through normalize_series
+def normalize_text(text):
+    if text is None or (isinstance(text, float) and math.isnan(text)): return ""
+    text = text.upper() if isinstance(text, str) else str(text).upper()
+    return _WS_RE.sub(' ', _DATE_RE.sub('', text)).strip()
 
-    def normalize_text(text):
-        if pd.isna(text): return ""
-        text = str(text).upper()
-        text = re.sub(r'\b\d{1,2}[-/]\d{1,2}[-/]\d{2,4}\b', '', text)
-        text = re.sub(r'\s+', ' ', text).strip()
-        return text
+# Same cleanup as normalize_text, applied to a whole column with pandas string ops.
+# Dates don't change case, so they are stripped before upper-casing together with
+# anything else strip_re matches.
+def normalize_series(series, strip_re=_DATE_RE):
+    return (series.fillna('').astype(str)
+            .str.replace(strip_re, '', regex=True)
+            .str.upper()
+            .str.replace(_WS_RE, ' ', regex=True)
+            .str.strip())
 
-    df['Normalized Corrective Action'] = df['Corrective Action'].apply(normalize_text)
-    df['Normalized Discrepancy'] = df['Description'].apply(lambda x: normalize_text(x.replace("(FOR REFERENCE ONLY)", "")))
-    df['Combined Key'] = df['Normalized Discrepancy'] + " | " + df['Normalized Corrective Action']
+# A key is only scored against representatives that share at least this fraction of
+# the word trigrams of the shorter of the two; misspelled words still share most of theirs
+_MIN_SHARED_GRAMS = 0.4
+# fuzzywuzzy rounded scores to whole numbers, so its ">= 90" matched from 89.5 up
+_CLUSTER_CUTOFF = 89.5
+
+# Character trigrams of each word, padded so short words like "LH" still have some
+def word_trigrams(processed):
+    return {w[i:i + 3] for w in (f" {t} " for t in processed.split()) for i in range(len(w) - 2)}
 
-    clusters = {}
-    for key in df['Combined Key'].unique():
-        if not key: continue
-        for rep in clusters:
-            if fuzz.token_set_ratio(key, rep) >= 90:
-                clusters[rep].append(key)
+# Registers key as a new representative and indexes its trigrams
+def add_representative(state, key, processed):
+    grams = word_trigrams(processed)
+    for g in grams:
+        state['gram_index'][g].append(len(state['reps']))
+    state['gram_counts'].append(len(grams))
+    state['reps'].append((key, processed))
+
+# Assign each new key to the first earlier representative it matches, only scoring
+# representatives whose trigrams overlap the key's enough. Keys already in the state
+# keep their cluster, and the state is updated in place.
+def build_clusters(keys, state):
+    reps, gram_index, gram_counts, key_to_rep = state['reps'], state['gram_index'], state['gram_counts'], state['key_to_rep']
+    for key in keys:
+        if key in key_to_rep: continue
+        processed = utils.default_process(key)
+        grams = word_trigrams(processed)
+        shared = Counter()
+        for g in grams:
+            if g in gram_index:
+                shared.update(gram_index[g])
+        need = _MIN_SHARED_GRAMS * len(grams)
+        candidates = sorted(r for r, n in shared.items() if n >= need or n >= _MIN_SHARED_GRAMS * gram_counts[r])
+        for r in candidates:
+            if fuzz.token_set_ratio(processed, reps[r][1]) >= _CLUSTER_CUTOFF:
+                key_to_rep[key] = reps[r][0]
                 break
         else:
-            clusters[key] = [key]
+            key_to_rep[key] = key
+            add_representative(state, key, processed)
+    return key_to_rep
+
+# Prepared workbooks are kept on disk so restarts skip the Excel parse and clustering
+CACHE_DIR = ".cache"
+# Cluster representatives and their trigram index, shared by every upload so a new
+# workbook only has to cluster the keys earlier ones haven't seen
+CLUSTER_STATE_PATH = os.path.join(CACHE_DIR, "clusters.pkl")
+
+def new_cluster_state():
+    return {'reps': [], 'gram_index': defaultdict(list), 'gram_counts': [], 'key_to_rep': {}}
+
+def load_cluster_state():
+    try:
+        with open(CLUSTER_STATE_PATH, 'rb') as f:
+            state = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return new_cluster_state()
+    if 'gram_index' not in state:
+        # Saved with the older word index: keep the clusters, re-index their representatives
+        reps, state = state['reps'], dict(new_cluster_state(), key_to_rep=state['key_to_rep'])
+        for key, processed in reps:
+            add_representative(state, key, processed)
+    return state
+
+def save_cluster_state(state):
+    def dump(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        write_atomically(CLUSTER_STATE_PATH, dump)
+    except OSError:
+        pass
 
-    key_to_rep = {k: r for r, lst in clusters.items() for k in lst}
+# Background preparations for different sessions run side by side; the cluster state
+# is loaded, extended and saved under this lock so no upload overwrites another's keys
+@st.cache_resource
+def cluster_state_lock():
+    return threading.Lock()
+
+# Writes to a temp file of this call's own and renames it into place, so concurrent
+# writers never share or move each other's half-written files
+def write_atomically(path, write):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+HMV_COLUMNS = ['Corrective Action', 'Description', 'Total Hours', 'Year', 'Orig. Card #']
+# Only needed by the card filter, so workbooks without it still load
+CARD_COLUMN = 'Orig. Card #'
+
+# Parse, normalize and cluster the workbook, reusing the copy on disk if there is one
+def prepare_frame(file_hash, file_bytes):
+    cache_path = os.path.join(CACHE_DIR, f"{file_hash}.feather")
+    if os.path.exists(cache_path):
+        try:
+            return pd.read_feather(cache_path)
+        except (OSError, ValueError):
+            # Truncated or unreadable copy: drop it and rebuild from the workbook
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+
+    # Only the columns the app uses (of those present); wide invoice workbooks carry many more
+    df = pd.read_excel(BytesIO(file_bytes), engine='calamine', usecols=lambda col: col in HMV_COLUMNS,
+                       dtype={CARD_COLUMN: str})
+
+    df['Normalized Corrective Action'] = normalize_series(df['Corrective Action'])
+    df['Normalized Discrepancy'] = normalize_series(df['Description'], _DESC_STRIP_RE)
+    df['Combined Key'] = df['Normalized Discrepancy'] + " | " + df['Normalized Corrective Action']
+
+    # Most frequent keys go first so they become the representatives, and the common
+    # variants behind them match early in their candidate lists
+    key_counts = df['Combined Key'].value_counts(sort=False).sort_values(ascending=False, kind='stable')
+    with cluster_state_lock():
+        cluster_state = load_cluster_state()
+        key_to_rep = build_clusters([k for k in key_counts.index if k], cluster_state)
+        save_cluster_state(cluster_state)
     df['Cluster Key'] = df['Combined Key'].map(key_to_rep)
 
+    # Arrow-backed strings: compact buffers and vectorized compares/contains. The raw
+    # text columns are cast too, since a numeric cell would leave them mixed-type
+    # and unwritable to Feather.
+    df = df.astype({col: 'string[pyarrow]' for col in [
+        CARD_COLUMN, 'Description', 'Corrective Action', 'Normalized Corrective Action', 'Normalized Discrepancy']
+        if col in df})
+    # The keys repeat heavily; as categories they group on integer codes
+    df = df.astype({'Combined Key': 'category', 'Cluster Key': 'category'})
+
     # Average total hours for clusters
-    hours = df.groupby('Cluster Key')['Total Hours'].agg(['mean', 'count']).reset_index()
-    hours.columns = ['Cluster Key', 'Actual Historic Hours', 'Occurrences']
-    df = df.merge(hours, on='Cluster Key', how='left')
+    hours = df.groupby('Cluster Key', sort=False, observed=True)['Total Hours']
+    df['Actual Historic Hours'] = hours.transform('mean')
+    df['Occurrences'] = hours.transform('count')
     df['Fair Quote (hrs)'] = df['Actual Historic Hours'].round(2)
 
+    try:
+        write_atomically(cache_path, lambda tmp_path: df.to_feather(tmp_path, compression='zstd'))
+    except OSError:
+        # Read-only or full disk: run without the disk cache
+        pass
+    return df
+
+# Each distinct word gets one code point, so a word list becomes a short string that
+# rapidfuzz compares natively; fuzz.ratio on it equals fuzz.ratio on the word list
+def encode_words(words, token_ids):
+    return "".join(chr(token_ids.setdefault(w, len(token_ids))) for w in words)
+
+# Query words the workbook never uses get fresh codes past the known ones
+def encode_query(words, token_ids):
+    new_ids = {}
+    return "".join(chr(token_ids[w]) if w in token_ids else chr(len(token_ids) + new_ids.setdefault(w, len(new_ids)))
+                   for w in words)
+
+# Prepared frame plus the lookups used by search(), built once per uploaded file:
+# word codes per distinct Combined Key (in category order), the word -> code map,
+# and Combined Key -> row positions for exact matches. Only the last few workbooks
+# stay in memory; older ones reload from their Feather copy on disk.
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_and_prepare(file_hash, _file_bytes):
+    df = prepare_frame(file_hash, _file_bytes)
+    key_index = df.groupby('Combined Key', sort=False, observed=True).indices
+    first_rows = np.unique(df['Combined Key'].cat.codes, return_index=True)[1]
+    token_ids = {}
+    key_codes = pd.DataFrame({
+        'Disc Codes': [encode_words(w, token_ids) for w in df['Normalized Discrepancy'].iloc[first_rows].str.split()],
+        'Corr Codes': [encode_words(w, token_ids) for w in df['Normalized Corrective Action'].iloc[first_rows].str.split()],
+    })
+    return df, key_codes, token_ids, key_index
+
+# Worker threads for workbook preparation, shared by all sessions
+@st.cache_resource
+def preparation_pool():
+    return ThreadPoolExecutor(max_workers=2)
+
+# Positions of the k largest values, best first (ties keep row order). Partitions
+# instead of sorting every candidate just to keep a couple of them.
+def top_k(values, positions, k):
+    if len(positions) > k:
+        kth = np.partition(values[positions], -k)[-k]
+        positions = positions[values[positions] >= kth]
+    return positions[np.argsort(-values[positions], kind='stable')[:k]]
+
+# Matching rows for a query. Results are kept across reruns, so resubmitting the
+# same text (e.g. with a different quote) skips the scoring pass.
+# Returns exact-match positions plus position -> Overlap series for the top 2
+# approximate matches and the nearest reference.
+@st.cache_data(max_entries=256, show_spinner=False)
+def search(file_hash, norm_disc, norm_corr, _df, _key_codes, _token_ids, _key_index):
+    exact_idx = _key_index.get(norm_disc + " | " + norm_corr, np.array([], dtype=np.int64))
+    if len(exact_idx):
+        return exact_idx, pd.Series(dtype=float), pd.Series(dtype=float)
+
+    # Word-level similarity against each distinct key, one batched call per column.
+    # Keys go on the query side because cdist spreads its workers over queries.
+    q_disc = encode_query(norm_disc.split(), _token_ids)
+    q_corr = encode_query(norm_corr.split(), _token_ids)
+    d_ov = process.cdist(_key_codes['Disc Codes'].tolist(), [q_disc], scorer=fuzz.ratio, workers=-1)[:, 0]
+    c_ov = process.cdist(_key_codes['Corr Codes'].tolist(), [q_corr], scorer=fuzz.ratio, workers=-1)[:, 0]
+    # Rows sharing a Combined Key have the same text, so they share its score
+    overlap = ((d_ov + c_ov) / 2)[_df['Combined Key'].cat.codes.to_numpy()]
+    top2_idx = top_k(overlap, np.flatnonzero(overlap >= 50), 2)
+    closest_idx = top_k(overlap, np.flatnonzero(overlap < 50), 1)
+    return (exact_idx, pd.Series(overlap[top2_idx], index=top2_idx),
+            pd.Series(overlap[closest_idx], index=closest_idx))
+
+# Words of text that are missing from ref_words, in bold red
+def highlight_diff(text, ref_words):
+    return " ".join(f"<b><span style='color:red'>{html.escape(w)}</span></b>" if w not in ref_words else html.escape(w) for w in text.split())
+
+# HTML for the approximate-match and nearest-reference tables. With refs given as the
+# normalized (description, corrective action) query, words not in it are highlighted.
+def result_table_html(rows, refs=None):
+    table = pd.DataFrame({
+        'Description': rows['Normalized Discrepancy'],
+        'Corrective Action': rows['Normalized Corrective Action'],
+        'Historic Hours': rows['Actual Historic Hours'],
+        'Fair Quote (hrs)': rows['Fair Quote (hrs)'],
+        'Occurrences': rows['Occurrences'],
+        'Overlap %': rows['Overlap'],
+    })
+    styler = table.style.format({'Historic Hours': '{:.2f}', 'Fair Quote (hrs)': '{:.2f}',
+                                 'Occurrences': '{}', 'Overlap %': '{:.1f}%'})
+    if refs:
+        ref_disc, ref_corr = (frozenset(ref.split()) for ref in refs)
+        styler = (styler.format(lambda text: highlight_diff(text, ref_disc), subset=['Description'])
+                  .format(lambda text: highlight_diff(text, ref_corr), subset=['Corrective Action']))
+    else:
+        styler = styler.format(html.escape, subset=['Description', 'Corrective Action'])
+    return styler.hide(axis='index').set_table_attributes('class="result-table"').to_html()
+
+# Conclusion text and colour, plus the formatted percentage difference and its CSS class
+def get_conclusion(supplier, fair):
+    if fair == 0:
+        return ("No historical data available - needs manual review", "red", "N/A (no historical data)", "diff-neutral")
+
+    ratio = (supplier - fair) / fair
+    in_range = abs(ratio) <= 0.05
+    percent_display = f"{ratio * 100:+.1f}%"
+    if ratio < 0:
+        diff_class = "diff-negative"
+    elif in_range:
+        diff_class = "diff-neutral"
+    else:
+        diff_class = "diff-positive"
+
+    if supplier < fair:
+        return ("Fair quote - approve quote", "green", percent_display, diff_class)
+    elif in_range:
+        return ("In expected range (±5%) - consider approving", "black", percent_display, diff_class)
+    else:
+        return ("Beyond expected range - needs BP review", "red", percent_display, diff_class)
+
+# Fair quote, supplier hours and percentage difference side by side
+def render_metric_cards(fair, supplier, percent_diff, diff_class):
+    cards = [
+        (f"{fair:.2f}", "metric-value", "Fair Quote based on historical data"),
+        (f"{supplier:.2f}", "metric-value", "Supplier Quoted Hours"),
+        (percent_diff, f"metric-value {diff_class}", "Percentage Difference"),
+    ]
+    for col, (value, value_class, label) in zip(st.columns(3), cards):
+        with col:
+            st.markdown(f"""
+                <div class="metric-card">
+                    <div class="{value_class}">{value}</div>
+                    <div class="metric-label">{label}</div>
+                </div>
+            """, unsafe_allow_html=True)
+
+# Conclusion with the match type and the matched cluster's history
+def render_conclusion_box(match_type, css_class, conclusion, color, row):
+    st.markdown(f"""
+        <div class="conclusion-box {css_class}">
+            <div style='display:flex; justify-content:space-between; align-items:center;'>
+                <div>
+                    <h3 style='margin:0; color:{color};'>Conclusion: {conclusion}</h3>
+                    <p style='margin:0; font-size:1.1rem;'>Match Type: <b>{match_type}</b></p>
+                </div>
+                <div style='text-align:right;'>
+                    <p style='margin:0; font-size:1.1rem;'>Historical Occurrences: <b>{row['Occurrences']}</b></p>
+                    <p style='margin:0; font-size:1.1rem;'>Average Hours: <b>{row['Actual Historic Hours']:.2f}</b></p>
+                </div>
+            </div>
+        </div>
+    """, unsafe_allow_html=True)
+
+# Upload file
+uploaded_file = st.file_uploader("Upload HMV Excel File (hmv_data.xlsx format):", type=["xlsx"])
+
+if uploaded_file:
+    file_bytes = uploaded_file.getvalue()
+    file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+    # Prepare a new file on a worker thread and poll it with reruns, so the page stays
+    # live while it runs; once done, load_and_prepare is a cache hit
+    if st.session_state.get('prepared_hash') != file_hash:
+        future = st.session_state.get('prepare_future')
+        if future is None or st.session_state.get('prepare_hash') != file_hash:
+            future = preparation_pool().submit(load_and_prepare, file_hash, file_bytes)
+            st.session_state['prepare_future'] = future
+            st.session_state['prepare_hash'] = file_hash
+        if not future.done():
+            show_loading("🔍 Processing your file...")
+            time.sleep(0.5)
+            st.rerun()
+        del st.session_state['prepare_future']
+        future.result()  # re-raise anything the worker hit
+        st.session_state['prepared_hash'] = file_hash
+
+    df, key_codes, token_ids, key_index = load_and_prepare(file_hash, file_bytes)
     hide_loading()
 
+    # Filter bounds only change with the file, so work them out once per upload
+    if st.session_state.get('filter_hash') != file_hash:
+        st.session_state['filter_hash'] = file_hash
+        st.session_state['years'] = sorted(df['Year'].dropna().unique())
+        st.session_state['hours_max'] = int(df['Total Hours'].max()) if df['Total Hours'].max() > 0 else 0
+
     st.sidebar.header("🔍 Filters")
-    all_years = sorted(df['Year'].dropna().unique())
+    all_years = st.session_state['years']
     year_filter = st.sidebar.multiselect("Select Year(s):", all_years, default=all_years)
     card_filter = st.sidebar.text_input("Card Number (partial):")
     
-    max_val = int(df['Total Hours'].max()) if df['Total Hours'].max() > 0 else 0
+    max_val = st.session_state['hours_max']
     min_hr, max_hr = st.sidebar.slider(
         "Hour Range", 
         0, 
@@ -228,10 +543,13 @@ if uploaded_file:
         (0, max_val)
     )
 
-    filtered_df = df[df['Year'].isin(year_filter)]
-    if card_filter:
-        filtered_df = filtered_df[filtered_df['Orig. Card #'].astype(str).str.contains(card_filter, case=False)]
-    filtered_df = filtered_df[(filtered_df['Total Hours'] >= min_hr) & (filtered_df['Total Hours'] <= max_hr)]
+    total_hours = df['Total Hours'].to_numpy()
+    mask = df['Year'].isin(year_filter).to_numpy() & (total_hours >= min_hr) & (total_hours <= max_hr)
+    if card_filter and CARD_COLUMN in df:
+        mask &= df[CARD_COLUMN].str.contains(card_filter, case=False).to_numpy(dtype=bool, na_value=False)
+    elif card_filter:
+        st.sidebar.warning(f"This workbook has no '{CARD_COLUMN}' column; the card filter is ignored.")
+    filtered_df = df[mask]
 
     st.markdown("### 📝 Enter Maintenance Details")
     with st.form("form", clear_on_submit=False):
@@ -254,269 +572,40 @@ if uploaded_file:
         
         norm_disc = normalize_text(discrepancy_input.replace("(FOR REFERENCE ONLY)", ""))
         norm_corr = normalize_text(corrective_input)
-        combined_input = norm_disc + " | " + norm_corr
-
-        exact = df[df['Combined Key'] == combined_input]
-
-        def semantic_overlap(a, b):
-            matcher = difflib.SequenceMatcher(None, a.split(), b.split())
-            return matcher.ratio() * 100
-
-        def total_similarity(row):
-            d_ov = semantic_overlap(norm_disc, row['Normalized Discrepancy'])
-            c_ov = semantic_overlap(norm_corr, row['Normalized Corrective Action'])
-            return (d_ov + c_ov) / 2
-
-        df['Overlap'] = df.apply(total_similarity, axis=1)
-        approx = df[(df['Overlap'] >= 50) & (df['Combined Key'] != combined_input)]
-        top2 = approx.sort_values(by='Overlap', ascending=False).head(2)
-        closest = df[df['Overlap'] < 50].sort_values(by='Overlap', ascending=False).head(1)
-
-        def get_conclusion(supplier, fair):
-            # Calculate percentage difference
-            if fair == 0:
-                percent_diff = "N/A"
-                diff_class = "diff-neutral"
-            else:
-                percent_diff = ((supplier - fair) / fair) * 100
-                if percent_diff < 0:
-                    diff_class = "diff-negative"
-                elif abs(percent_diff) <= 5:
-                    diff_class = "diff-neutral"
-                else:
-                    diff_class = "diff-positive"
-            
-            # Format percentage display
-            if fair == 0:
-                percent_display = "N/A (no historical data)"
-            else:
-                sign = "+" if percent_diff >= 0 else ""
-                percent_display = f"{sign}{percent_diff:.1f}%"
-            
-            # Generate conclusion text
-            if fair == 0:
-                return ("No historical data available - needs manual review", "red", percent_display, diff_class)
-            if supplier < fair:
-                return ("Fair quote - approve quote", "green", percent_display, diff_class)
-            elif abs(supplier - fair) / fair <= 0.05:
-                return ("In expected range (±5%) - consider approving", "black", percent_display, diff_class)
-            else:
-                return ("Beyond expected range - needs BP review", "red", percent_display, diff_class)
-        
+
+        exact_idx, top2_overlap, closest_overlap = search(file_hash, norm_disc, norm_corr, df, key_codes, token_ids, key_index)
+        exact = df.iloc[exact_idx]
+        top2 = df.iloc[top2_overlap.index].assign(Overlap=top2_overlap.to_numpy())
+        closest = df.iloc[closest_overlap.index].assign(Overlap=closest_overlap.to_numpy())
+
         hide_loading()
 
-        # Always show conclusion in a consistent box at the top
-        conclusion_box = None
-        
         if not exact.empty:
             row = exact.iloc[0]
             conclusion, color, percent_diff, diff_class = get_conclusion(supplier_hours, row['Fair Quote (hrs)'])
-            
-            # Create metrics cards
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value">{row['Fair Quote (hrs)']:.2f}</div>
-                        <div class="metric-label">Fair Quote based on historical data</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            with col2:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value">{supplier_hours:.2f}</div>
-                        <div class="metric-label">Supplier Quoted Hours</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            with col3:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value {diff_class}">{percent_diff}</div>
-                        <div class="metric-label">Percentage Difference</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            
-            # Enhanced conclusion box
-            conclusion_box = st.markdown(f"""
-                <div class="conclusion-box exact-match">
-                    <div style='display:flex; justify-content:space-between; align-items:center;'>
-                        <div>
-                            <h3 style='margin:0; color:{color};'>Conclusion: {conclusion}</h3>
-                            <p style='margin:0; font-size:1.1rem;'>Match Type: <b>Exact Match</b></p>
-                        </div>
-                        <div style='text-align:right;'>
-                            <p style='margin:0; font-size:1.1rem;'>Historical Occurrences: <b>{row['Occurrences']}</b></p>
-                            <p style='margin:0; font-size:1.1rem;'>Average Hours: <b>{row['Actual Historic Hours']:.2f}</b></p>
-                        </div>
-                    </div>
-                </div>
-            """, unsafe_allow_html=True)
-            
+            render_metric_cards(row['Fair Quote (hrs)'], supplier_hours, percent_diff, diff_class)
+            render_conclusion_box("Exact Match", "exact-match", conclusion, color, row)
+
             st.success("### ✅ Exact Match Found")
             st.dataframe(exact[['Description', 'Corrective Action', 'Actual Historic Hours', 'Fair Quote (hrs)', 'Occurrences']].style.set_properties(**{'white-space': 'pre-wrap'}), use_container_width=True)
 
         elif not top2.empty:
             row = top2.iloc[0]
             conclusion, color, percent_diff, diff_class = get_conclusion(supplier_hours, row['Fair Quote (hrs)'])
-            
-            # Create metrics cards
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value">{row['Fair Quote (hrs)']:.2f}</div>
-                        <div class="metric-label">Fair Quote based on historical data</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            with col2:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value">{supplier_hours:.2f}</div>
-                        <div class="metric-label">Supplier Quoted Hours</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            with col3:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value {diff_class}">{percent_diff}</div>
-                        <div class="metric-label">Percentage Difference</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            
-            # Enhanced conclusion box
-            conclusion_box = st.markdown(f"""
-                <div class="conclusion-box approx-match">
-                    <div style='display:flex; justify-content:space-between; align-items:center;'>
-                        <div>
-                            <h3 style='margin:0; color:{color};'>Conclusion: {conclusion}</h3>
-                            <p style='margin:0; font-size:1.1rem;'>Match Type: <b>Approximate Match</b></p>
-                        </div>
-                        <div style='text-align:right;'>
-                            <p style='margin:0; font-size:1.1rem;'>Historical Occurrences: <b>{row['Occurrences']}</b></p>
-                            <p style='margin:0; font-size:1.1rem;'>Average Hours: <b>{row['Actual Historic Hours']:.2f}</b></p>
-                        </div>
-                    </div>
-                </div>
-            """, unsafe_allow_html=True)
-            
-            st.info("### 🔍 Approximate Matches (Top 2)")
+            render_metric_cards(row['Fair Quote (hrs)'], supplier_hours, percent_diff, diff_class)
+            render_conclusion_box("Approximate Match", "approx-match", conclusion, color, row)
 
-            def highlight_diff(text, ref):
-                ref_words = set(ref.split())
-                return " ".join([f"<b><span style='color:red'>{w}</span></b>" if w not in ref_words else w for w in text.split()])
-
-            rows = []
-            for _, row in top2.iterrows():
-                rows.append({
-                    'Description': highlight_diff(row['Normalized Discrepancy'], norm_disc),
-                    'Corrective Action': highlight_diff(row['Normalized Corrective Action'], norm_corr),
-                    'Actual Historic Hours': f"{row['Actual Historic Hours']:.2f}",
-                    'Fair Quote (hrs)': f"{row['Fair Quote (hrs)']:.2f}",
-                    'Occurrences': row['Occurrences'],
-                    'Overlap %': f"{row['Overlap']:.1f}%"
-                })
-            
-            # Create HTML table
-            html_table = f"""
-            <table class="result-table">
-                <thead>
-                    <tr>
-                        <th>Description</th>
-                        <th>Corrective Action</th>
-                        <th>Historic Hours</th>
-                        <th>Fair Quote (hrs)</th>
-                        <th>Occurrences</th>
-                        <th>Overlap %</th>
-                    </tr>
-                </thead>
-                <tbody>
-            """
-            
-            for row in rows:
-                html_table += f"""
-                <tr>
-                    <td>{row['Description']}</td>
-                    <td>{row['Corrective Action']}</td>
-                    <td>{row['Actual Historic Hours']}</td>
-                    <td>{row['Fair Quote (hrs)']}</td>
-                    <td>{row['Occurrences']}</td>
-                    <td>{row['Overlap %']}</td>
-                </tr>
-                """
-            
-            html_table += "</tbody></table>"
-            st.markdown(html_table, unsafe_allow_html=True)
+            st.info("### 🔍 Approximate Matches (Top 2)")
+            st.markdown(result_table_html(top2, refs=(norm_disc, norm_corr)), unsafe_allow_html=True)
 
         elif not closest.empty:
             row = closest.iloc[0]
             conclusion, color, percent_diff, diff_class = get_conclusion(supplier_hours, row['Fair Quote (hrs)'])
-            
-            # Create metrics cards
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value">{row['Fair Quote (hrs)']:.2f}</div>
-                        <div class="metric-label">Fair Quote based on historical data</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            with col2:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value">{supplier_hours:.2f}</div>
-                        <div class="metric-label">Supplier Quoted Hours</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            with col3:
-                st.markdown(f"""
-                    <div class="metric-card">
-                        <div class="metric-value {diff_class}">{percent_diff}</div>
-                        <div class="metric-label">Percentage Difference</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            
-            # Enhanced conclusion box
-            conclusion_box = st.markdown(f"""
-                <div class="conclusion-box closest-match">
-                    <div style='display:flex; justify-content:space-between; align-items:center;'>
-                        <div>
-                            <h3 style='margin:0; color:{color};'>Conclusion: {conclusion}</h3>
-                            <p style='margin:0; font-size:1.1rem;'>Match Type: <b>Nearest Reference</b></p>
-                        </div>
-                        <div style='text-align:right;'>
-                            <p style='margin:0; font-size:1.1rem;'>Historical Occurrences: <b>{row['Occurrences']}</b></p>
-                            <p style='margin:0; font-size:1.1rem;'>Average Hours: <b>{row['Actual Historic Hours']:.2f}</b></p>
-                        </div>
-                    </div>
-                </div>
-            """, unsafe_allow_html=True)
-            
+            render_metric_cards(row['Fair Quote (hrs)'], supplier_hours, percent_diff, diff_class)
+            render_conclusion_box("Nearest Reference", "closest-match", conclusion, color, row)
+
             st.warning("### 📝 No close matches found — showing nearest reference")
-            html_ref = f"""
-            <table class="result-table">
-                <thead>
-                    <tr>
-                        <th>Description</th>
-                        <th>Corrective Action</th>
-                        <th>Historic Hours</th>
-                        <th>Fair Quote (hrs)</th>
-                        <th>Occurrences</th>
-                        <th>Overlap %</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    <tr>
-                        <td>{row['Normalized Discrepancy']}</td>
-                        <td>{row['Normalized Corrective Action']}</td>
-                        <td>{row['Actual Historic Hours']:.2f}</td>
-                        <td>{row['Fair Quote (hrs)']:.2f}</td>
-                        <td>{row['Occurrences']}</td>
-                        <td>{row['Overlap']:.1f}%</td>
-                    </tr>
-                </tbody>
-            </table>
-            """
-            st.markdown(html_ref, unsafe_allow_html=True)
+            st.markdown(result_table_html(closest), unsafe_allow_html=True)
 
 else:
     st.info("Please upload the 'hmv_data.xlsx' file to begin.")
\ No newline at end of file